@@ -6,6 +6,7 @@ Helper script for Flatpak.
 This script starts Flatpak version of Steam and steamruntime_helper.py.
 """
 
+import math
 import os
 import subprocess as subproc
 import sys
@@ -22,15 +23,20 @@ def wait_for_flatpak_steam(timeout=99):
     except OSError:
         loginvdf_timestamp = 0
 
-    waittime = timeout
-    while waittime > 0:
-        # "\r" can't be used here because this helper is subprocess
-        print(ngettext(
-            "Waiting {} second for steam to start up.",
-            "Waiting {} seconds for steam to start up.",
-            waittime).format(waittime), flush=True)
-        time.sleep(1)
-        waittime -= 1
+    deadline = time.monotonic() + timeout
+    shown_waittime = None
+    while time.monotonic() < deadline:
+        # print the countdown every second but check the timestamp
+        # several times per second to notice the login soon
+        waittime = math.ceil(deadline - time.monotonic())
+        if waittime != shown_waittime:
+            # "\r" can't be used here because this helper is subprocess
+            print(ngettext(
+                "Waiting {} second for steam to start up.",
+                "Waiting {} seconds for steam to start up.",
+                waittime).format(waittime), flush=True)
+            shown_waittime = waittime
+        time.sleep(0.25)
         try:
             stat = os.stat(loginvdf)
             if stat.st_mtime > loginvdf_timestamp:
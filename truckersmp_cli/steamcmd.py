@@ -4,15 +4,20 @@ SteamCMD handler for truckersmp-cli main script.
 Licensed under MIT.
 """
 
+import contextlib
 import io
 import logging
 import os
 import platform
+import shutil
 import subprocess as subproc
 import sys
 import tarfile
+import tempfile
+import time
 import urllib.parse
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from zipfile import ZipFile
 
 from .truckersmp import determine_game_branch
@@ -35,15 +40,58 @@ class SteamCMD:
         self._wine = wine
         self._env = env
 
+    def _format_env(self):
+        """Return a string of environment variables for logging."""
+        if self._env is None:
+            return ""
+        env_print = ("WINEDEBUG", "WINEARCH", "WINEPREFIX", "WINEDLLOVERRIDES")
+        return "".join(f"{name}={self._env[name]}\n  " for name in env_print)
+
+    @staticmethod
+    def _format_cmdline(cmdline):
+        """
+        Return a string of SteamCMD command line for logging.
+
+        cmdline: SteamCMD command line (list)
+        """
+        parts = []
+        for i, arg in enumerate(cmdline):
+            if arg.startswith("+"):
+                # add newline before SteamCMD commands (e.g. "+login")
+                parts.append("\n    ")
+            elif i > 0:
+                parts.append(" ")
+            parts.append(arg)
+        return "".join(parts)
+
+    @staticmethod
+    def create_directories():
+        """
+        Create all directories for SteamCMD and the installations at once.
+
+        This must be called before download_steamcmd() and install_via_steamcmd().
+        """
+        # Dir.steamcmdpfx is in Dir.steamcmddir
+        needed_dirs = [Dir.steamcmdpfx, Args.gamedir]
+        if Args.proton and not Args.skip_update_proton:
+            needed_dirs.append(Args.protondir)
+            if not Args.disable_steamruntime:
+                needed_dirs.append(Args.steamruntimedir)
+        for path in needed_dirs:
+            os.makedirs(path, exist_ok=True)
+
     @staticmethod
     def download_steamcmd(dest, url):
         """
         Download SteamCMD if it doesn't exist in our data directory.
 
+        The files are extracted into a temporary location and moved into place
+        (SteamCMD executable last) so an interrupted extraction is not mistaken
+        for a complete one.
+
         dest: SteamCMD destination path
         url: SteamCMD download URL
         """
-        os.makedirs(Dir.steamcmddir, exist_ok=True)
         if not os.path.isfile(dest):
             logging.debug("Retrieving SteamCMD")
             try:
@@ -54,20 +102,38 @@ class SteamCMD:
             logging.debug("Extracting SteamCMD")
             try:
                 if Args.proton:
-                    with tarfile.open(
-                            fileobj=io.BytesIO(archive), mode="r:gz") as f_in:
-                        check_and_unpack_tar(f_in, path=Dir.steamcmddir)
+                    with tempfile.TemporaryDirectory(dir=Dir.steamcmddir) as tmpdir:
+                        with tarfile.open(
+                                fileobj=io.BytesIO(archive), mode="r:gz") as f_in:
+                            check_and_unpack_tar(f_in, path=tmpdir)
+                        # move "steamcmd.sh" last
+                        for name in sorted(
+                                os.listdir(tmpdir),
+                                key=lambda name: name == os.path.basename(dest)):
+                            path = os.path.join(Dir.steamcmddir, name)
+                            # remove the remains of an interrupted extraction
+                            if os.path.isdir(path) and not os.path.islink(path):
+                                shutil.rmtree(path)
+                            os.replace(os.path.join(tmpdir, name), path)
                 else:
-                    with ZipFile(io.BytesIO(archive)) as f_in:
-                        with f_in.open("steamcmd.exe") as f_exe:
-                            with open(dest, "wb") as f_out:
-                                f_out.write(f_exe.read())
+                    partfile = dest + ".part"
+                    try:
+                        with ZipFile(io.BytesIO(archive)) as f_in:
+                            with f_in.open("steamcmd.exe") as f_exe:
+                                # stream it instead of reading the whole file
+                                with open(partfile, "wb") as f_out:
+                                    shutil.copyfileobj(f_exe, f_out, 1 << 20)
+                        os.replace(partfile, dest)
+                    finally:
+                        # remove incomplete file
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(partfile)
             except (OSError, tarfile.TarError) as ex:
                 sys.exit(f"Failed to extract SteamCMD: {ex}")
         logging.info("SteamCMD: %s", dest)
 
     @staticmethod
-    def install_via_steamcmd(steamcmd_path, gamedir, wine, env):
+    def install_via_steamcmd(steamcmd_path, gamedir, wine, env, branch_future):
         """
         Install Proton, Steam Runtime, and the specified game via SteamCMD.
 
@@ -76,6 +142,8 @@ class SteamCMD:
                  (DOS/Windows style path when using Wine, otherwise UNIX style path)
         wine: Wine command, not used when using Proton
         env: A dict of environment variables for Wine, not used when using Proton
+        branch_future: A concurrent.futures.Future object
+                       that returns the game branch name
         """
         steamcmd = SteamCMD(
             steamcmd_path,
@@ -83,13 +151,14 @@ class SteamCMD:
             env=env if not Args.proton else None,
         )
 
+        # each app is updated in its own SteamCMD session because
+        # "+force_install_dir" must be used before "+login"
         if Args.proton:
             if Args.skip_update_proton:
                 logging.info("Skipping updating Proton and Steam Runtime")
             else:
                 if not Args.disable_steamruntime:
                     # download/update Steam Runtime and Proton
-                    os.makedirs(Args.steamruntimedir, exist_ok=True)
                     # Proton and Steam Linux Runtime work only on Linux systems
                     appid_steamruntime = AppId.steamruntime["Linux"]
                     logging.debug("Updating Steam Runtime (AppID:%s)", appid_steamruntime)
@@ -102,7 +171,6 @@ class SteamCMD:
                             "+quit",
                         ]
                     )
-                os.makedirs(Args.protondir, exist_ok=True)
                 logging.debug("Updating Proton (AppID:%s)", Args.proton_appid)
                 steamcmd.run(
                     [
@@ -114,12 +182,11 @@ class SteamCMD:
                     ]
                 )
 
-        # determine game branch
-        branch = determine_game_branch()
+        # wait for the game branch determined in background
+        branch = branch_future.result()
         logging.info("Game branch: %s", branch)
 
         # use SteamCMD to update the chosen game
-        os.makedirs(Args.gamedir, exist_ok=True)
         logging.debug("Updating Game (AppID:%s)", Args.steamid)
         steamcmd.run(
             [
@@ -145,22 +212,11 @@ class SteamCMD:
         if Args.download_throttle > 0:
             cmdline += ["+set_download_throttle", str(Args.download_throttle)]
         cmdline += args
-        env_str = ""
-        if self._env is not None:
-            env_print = ("WINEDEBUG", "WINEARCH", "WINEPREFIX", "WINEDLLOVERRIDES")
-            name_value_pairs = []
-            for name in env_print:
-                name_value_pairs.append(f"{name}={self._env[name]}")
-            env_str += "\n  ".join(name_value_pairs) + "\n  "
-        cmd_str = ""
-        for i, arg in enumerate(cmdline):
-            if arg.startswith("+"):
-                # add newline before SteamCMD commands (e.g. "+login")
-                cmd_str += "\n    "
-            elif i > 0:
-                cmd_str += " "
-            cmd_str += arg
-        logging.info("Running SteamCMD:\n  %s%s", env_str, cmd_str)
+        # don't build the command line string when it won't be printed
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info(
+                "Running SteamCMD:\n  %s%s",
+                self._format_env(), SteamCMD._format_cmdline(cmdline))
 
         try:
             subproc.check_call(cmdline, env=self._env)
@@ -168,6 +224,52 @@ class SteamCMD:
             sys.exit("SteamCMD exited abnormally")
 
 
+def close_steam(wine, env, timeout=15):
+    """
+    Close Linux and Windows version of Steam.
+
+    Both shutdown commands are started first and then waited for
+    at most "timeout" seconds in total, so a hung Steam client
+    can't block updating forever.
+
+    wine: Wine command (path or name), or None if Wine is not available
+    env: A dict of environment variables for Windows version of Steam
+    timeout: timeout in seconds
+    """
+    # pylint: disable=consider-using-with
+
+    procs = []
+    # Linux version of Steam
+    if platform.system() == "Linux":
+        try:
+            logging.debug("Trying to close Flatpak version of Steam")
+            subproc.check_call(
+                ("flatpak", "kill", "com.valvesoftware.Steam"), stderr=subproc.DEVNULL)
+        except (OSError, subproc.CalledProcessError):
+            pass
+        if check_steam_process(use_proton=True):
+            logging.debug("Closing Linux version of Steam")
+            procs.append(subproc.Popen(("steam", "-shutdown")))
+    # Windows version of Steam
+    if (Args.check_windows_steam
+            and wine
+            and check_steam_process(use_proton=False, wine=wine, env=env)):
+        logging.debug("Closing Windows version of Steam in %s", Args.wine_steam_dir)
+        procs.append(
+            subproc.Popen(
+                (wine, os.path.join(Args.wine_steam_dir, "steam.exe"), "-shutdown"),
+                env=env))
+
+    deadline = time.monotonic() + timeout
+    for proc in procs:
+        with proc:
+            try:
+                proc.wait(timeout=max(deadline - time.monotonic(), 0))
+            except subproc.TimeoutExpired:
+                logging.warning("Steam shutdown timed out: %s", proc.args)
+                proc.kill()
+
+
 def update_game():
     """
     Update game and Proton via SteamCMD.
@@ -181,23 +283,32 @@ def update_game():
     SteamCMD. When "--proton" is specified, this retrieves/uses
     Linux version of SteamCMD.
     """
-    env = os.environ.copy()
-    env.update(WINEDEBUG="-all", WINEARCH="win64")
-    env_steam = env.copy()
-    # Proton's "prefix" is for STEAM_COMPAT_DATA_PATH that contains
-    # the directory "pfx" for WINEPREFIX
-    env_steam["WINEPREFIX"] = os.path.join(Args.prefixdir, "pfx") if Args.proton \
-        else Args.prefixdir
-    env.update(
+    # determine game branch in background because it doesn't depend on SteamCMD
+    # (the executor doesn't wait for the task here, the result is waited for
+    #  in install_via_steamcmd())
+    executor = ThreadPoolExecutor(max_workers=1)
+    branch_future = executor.submit(determine_game_branch)
+    executor.shutdown(wait=False)
+
+    env_common = {"WINEDEBUG": "-all", "WINEARCH": "win64"}
+    env = {
+        **os.environ, **env_common,
         # use a prefix only for SteamCMD to avoid every-time authentication
-        WINEPREFIX=Dir.steamcmdpfx,
+        "WINEPREFIX": Dir.steamcmdpfx,
         # don't show "The Wine configuration is being updated" dialog
         # or install Gecko/Mono
-        WINEDLLOVERRIDES="winex11.drv=",
-    )
+        "WINEDLLOVERRIDES": "winex11.drv=",
+    }
+    env_steam = {
+        **os.environ, **env_common,
+        # Proton's "prefix" is for STEAM_COMPAT_DATA_PATH that contains
+        # the directory "pfx" for WINEPREFIX
+        "WINEPREFIX": os.path.join(Args.prefixdir, "pfx") if Args.proton
+        else Args.prefixdir,
+    }
 
     wine = env["WINE"] if "WINE" in env else "wine"
-    os.makedirs(Dir.steamcmdpfx, exist_ok=True)
+    SteamCMD.create_directories()
     if Args.check_windows_steam:
         try:
             subproc.check_call((wine, "--version"), stdout=subproc.DEVNULL, env=env)
@@ -228,25 +339,7 @@ def update_game():
     # fetch SteamCMD if not in our data directory
     SteamCMD.download_steamcmd(steamcmd_path, steamcmd_url)
 
-    # Linux version of Steam
-    if platform.system() == "Linux":
-        try:
-            logging.debug("Trying to close Flatpak version of Steam")
-            subproc.check_call(
-                ("flatpak", "kill", "com.valvesoftware.Steam"), stderr=subproc.DEVNULL)
-        except (OSError, subproc.CalledProcessError):
-            pass
-        if check_steam_process(use_proton=True):
-            logging.debug("Closing Linux version of Steam")
-            subproc.call(("steam", "-shutdown"))
-    # Windows version of Steam
-    if (Args.check_windows_steam
-            and wine
-            and check_steam_process(use_proton=False, wine=wine, env=env_steam)):
-        logging.debug("Closing Windows version of Steam in %s", Args.wine_steam_dir)
-        subproc.call(
-            (wine, os.path.join(Args.wine_steam_dir, "steam.exe"), "-shutdown"),
-            env=env_steam)
+    close_steam(wine, env_steam)
 
     # install via SteamCMD
-    SteamCMD.install_via_steamcmd(steamcmd_path, gamedir, wine, env)
+    SteamCMD.install_via_steamcmd(steamcmd_path, gamedir, wine, env, branch_future)
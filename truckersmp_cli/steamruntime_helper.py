@@ -98,22 +98,30 @@ def main():
             if args.verbose:
                 print("Proton output:")
             if proc.stdout is not None:
-                for line in proc.stdout:
-                    try:
-                        print(line.decode("utf-8"), end="", flush=True)
-                    except UnicodeDecodeError:
-                        print(
-                            "!! NON UNICODE OUTPUT !!", repr(line),
-                            sep="  ", end="", flush=True)
+                # forward raw output as it arrives without decoding every line
+                # (truckersmp-cli decodes the output of this helper)
+                sys.stdout.flush()
+                for buf in iter(lambda: proc.stdout.read1(65536), b""):
+                    sys.stdout.buffer.write(buf)
+                    sys.stdout.buffer.flush()
                 proc.wait()
     except subproc.CalledProcessError as ex:
         print("Proton output:\n" + ex.output.decode("utf-8"), file=sys.stderr)
 
-    for proc in thirdparty_processes + early_thirdparty_processes:
-        # make sure 3rd party programs is exited
+    # make sure 3rd party programs is exited:
+    # ask all of them to exit first and then wait for them together
+    # so that the total waiting time is not the sum of them
+    thirdparty_processes += early_thirdparty_processes
+    for proc in thirdparty_processes:
         if proc.poll() is None:
+            proc.terminate()
+    deadline = time.monotonic() + 2
+    for proc in thirdparty_processes:
+        try:
+            proc.wait(timeout=max(deadline - time.monotonic(), 0))
+        except subproc.TimeoutExpired:
             proc.kill()
-        proc.wait()
+            proc.wait()
 
 
 if __name__ == "__main__":
@@ -4,18 +4,45 @@ TruckersMP handler for truckersmp-cli main script.
 Licensed under MIT.
 """
 
-import hashlib
 import json
 import logging
 import os
 import sys
 import urllib.parse
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 
-from .utils import check_hash, download_files
+from .utils import (
+    check_hash, download_files, load_hash_cache, new_md5, save_hash_cache,
+)
 from .variables import Args, URL
 
 
+def check_modfile(modfile, hash_cache):
+    """
+    Check whether the given mod file needs to be downloaded.
+
+    This returns a tuple for download_files()
+    if the local file is missing or its MD5 hash is wrong.
+    Otherwise, this returns None.
+    OSError is raised when the local file can't be read.
+
+    modfile: A tuple of (MD5 hex digest, file path in files.json)
+    hash_cache: A dict from load_hash_cache()
+    """
+    md5, jsonfilepath = modfile
+    modfilepath = os.path.join(Args.moddir, jsonfilepath[1:])
+    # each thread uses its own md5 object
+    # (check_hash() stats the file first for the hash cache,
+    #  so missing files are found without another stat() call)
+    try:
+        if check_hash(modfilepath, md5, new_md5(), hash_cache):
+            return None
+    except (FileNotFoundError, IsADirectoryError):
+        pass
+    return ("/files" + jsonfilepath, modfilepath, md5)
+
+
 def determine_game_branch():
     """
     Determine Steam game branch name.
@@ -75,42 +102,42 @@ def get_supported_game_versions():
 
 def update_mod():
     """Download missing or outdated "multiplayer mod" files."""
-    # pylint: disable=too-many-branches
+    # pylint: disable=too-many-branches,too-many-locals
 
     logging.debug("Creating directory %s if it doesn't exist", Args.moddir)
     os.makedirs(Args.moddir, exist_ok=True)
 
     # get the fileinfo from the server
+    # and extract md5sums and filenames
     try:
         with urllib.request.urlopen(URL.listurl) as f_in:
-            files_json = f_in.read()
-    except OSError as ex:
-        sys.exit(f"Failed to download files.json: {ex}")
-
-    # extract md5sums and filenames
-    modfiles = []
-    try:
-        for item in json.JSONDecoder().decode(str(files_json, "ascii"))["Files"]:
-            modfiles.append((item["Md5"], item["FilePath"]))
+            # parse the response directly without making a str copy
+            files_json = json.load(f_in)
+        modfiles = [(item["Md5"], item["FilePath"]) for item in files_json["Files"]]
         if len(modfiles) == 0:
             raise ValueError("File list is empty")
+    except OSError as ex:
+        sys.exit(f"Failed to download files.json: {ex}")
     except ValueError as ex:
         sys.exit(f"Failed to parse files.json: {ex}\n"
                  f"Please report an issue: {URL.issueurl}")
 
-    # compare existing local files with md5sums
+    # compare local files with md5sums in parallel
     # and remember missing/wrong files
-    dlfiles = []
-    for md5, jsonfilepath in modfiles:
-        modfilepath = os.path.join(Args.moddir, jsonfilepath[1:])
-        if not os.path.isfile(modfilepath):
-            dlfiles.append(("/files" + jsonfilepath, modfilepath, md5))
-            continue
-        try:
-            if not check_hash(modfilepath, md5, hashlib.md5()):
-                dlfiles.append(("/files" + jsonfilepath, modfilepath, md5))
-        except OSError as ex:
-            sys.exit(f"Failed to read {modfilepath}: {ex}")
+    # (unchanged files that are already checked are not hashed again)
+    hash_cache = load_hash_cache()
+    original_hash_cache = hash_cache.copy()
+    try:
+        if len(modfiles) < 4:
+            # starting threads costs more than checking a few files
+            results = [check_modfile(modfile, hash_cache) for modfile in modfiles]
+        else:
+            with ThreadPoolExecutor() as executor:
+                results = list(executor.map(
+                    check_modfile, modfiles, [hash_cache, ] * len(modfiles)))
+        dlfiles = [dlfile for dlfile in results if dlfile is not None]
+    except OSError as ex:
+        sys.exit(f"Failed to read {ex.filename}: {ex}")
     if len(dlfiles) > 0:
         message_dlfiles = "Files to download:\n"
         for path, _, _ in dlfiles:
@@ -120,7 +147,11 @@ def update_mod():
         logging.debug("No files to download")
 
     # download missing/wrong files
-    if not download_files(URL.dlurl, dlfiles):
-        if not download_files(URL.dlurlalt, dlfiles):
-            # something went wrong
-            sys.exit("Failed to download mod files.")
+    # (the cache is saved with the downloaded files even if some of them failed)
+    try:
+        if not download_files(URL.dlurl, dlfiles, hash_cache=hash_cache):
+            if not download_files(URL.dlurlalt, dlfiles, hash_cache=hash_cache):
+                # something went wrong
+                sys.exit("Failed to download mod files.")
+    finally:
+        save_hash_cache(hash_cache, original_hash_cache)
@@ -1,35 +1,44 @@
+# pylint: disable=too-many-lines
+
 """
 Utilities for truckersmp-cli main script.
 
 Licensed under MIT.
 """
 
+import contextlib
 import ctypes
+import functools
 import glob
 import hashlib
 import http.client
-import io
+import importlib.util
+import json
 import logging
+import math
+import mmap
 import os
 import platform
+import re
 import shutil
+import ssl
 import subprocess as subproc
 import sys
 import tarfile
+import tempfile
+import threading
 import time
 import urllib.parse
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
 from getpass import getuser
 from gettext import ngettext
 
 from .variables import Args, Dir, File, URL
 
-VDF_IS_AVAILABLE = False
-try:
-    import vdf
-    VDF_IS_AVAILABLE = True
-except ImportError:
-    pass
+# "vdf" is imported only when it's used (see get_current_steam_user())
+VDF_IS_AVAILABLE = importlib.util.find_spec("vdf") is not None
 
 
 def activate_native_d3dcompiler_47(prefix, wine):
@@ -39,9 +48,13 @@ def activate_native_d3dcompiler_47(prefix, wine):
     wine: A list used to run Wine executable
     """
     # check whether DLL is already downloaded
+    # (the unchanged DLL is not hashed again)
     need_download = True
+    hash_cache = load_hash_cache()
+    original_hash_cache = hash_cache.copy()
     try:
-        if check_hash(File.d3dcompiler_47, File.d3dcompiler_47_md5, hashlib.md5()):
+        if check_hash(
+                File.d3dcompiler_47, File.d3dcompiler_47_md5, new_md5(), hash_cache):
             logging.debug("d3dcompiler_47.dll is present, MD5 is OK.")
             need_download = False
     except OSError:
@@ -54,22 +67,22 @@ def activate_native_d3dcompiler_47(prefix, wine):
         os.makedirs(Dir.dllsdir, exist_ok=True)
         if not download_files(
                 URL.github,
-                [(URL.d3dcompilerpath, File.d3dcompiler_47, File.d3dcompiler_47_md5), ]):
+                [(URL.d3dcompilerpath, File.d3dcompiler_47, File.d3dcompiler_47_md5), ],
+                hash_cache=hash_cache):
             sys.exit("Failed to download d3dcompiler_47.dll")
+    save_hash_cache(hash_cache, original_hash_cache)
 
     # copy into system32
     destdir = os.path.join(prefix, Dir.system32_inner)
     logging.debug("Copying d3dcompiler_47.dll into %s", destdir)
-    shutil.copy(File.d3dcompiler_47, destdir)
+    # only the data is needed, so use shutil.copyfile()
+    # to skip the chmod() that shutil.copy() does after copying
+    shutil.copyfile(
+        File.d3dcompiler_47,
+        os.path.join(destdir, os.path.basename(File.d3dcompiler_47)))
 
     # add DLL override setting
-    env = os.environ.copy()
-    env.update(WINEDEBUG="-all", WINEPREFIX=prefix)
-    if Args.proton:
-        env.update(
-            WINEESYNC="0" if is_envar_enabled(env, "PROTON_NO_ESYNC") else "1",
-            WINEFSYNC="0" if is_envar_enabled(env, "PROTON_NO_FSYNC") else "1",
-        )
+    env = get_wine_reg_env(prefix)
     exename = "eurotrucks2.exe" if Args.ets2 else "amtrucks.exe"
     logging.debug("Adding DLL override setting for %s", exename)
     subproc.call(
@@ -99,7 +112,7 @@ def check_and_unpack_tar(f_tar, path=".", members=None, *, numeric_owner=False):
     f_tar.extractall(path, members, numeric_owner=numeric_owner)
 
 
-def check_hash(path, digest, hashobj):
+def check_hash(path, digest, hashobj, cache=None):
     """
     Compare given digest and calculated one.
 
@@ -108,15 +121,46 @@ def check_hash(path, digest, hashobj):
 
     path: Path to the input file
     digest: Expected hex digest string
-    hashobj: hashlib object (e.g. hashlib.md5())
+    hashobj: hashlib object (e.g. new_md5())
+    cache: A dict from load_hash_cache() or None
+           (if the file size and mtime are unchanged since the digest
+            was stored, the file is not read; updated when the digests match)
     """
+    if cache is not None:
+        stat = os.stat(path)
+        file_info = [stat.st_size, stat.st_mtime_ns, digest]
+        if cache.get(path) == file_info:
+            return True
     with open(path, "rb") as f_in:
-        while True:
-            buf = f_in.read(hashobj.block_size * 4096)
-            if not buf:
-                break
-            hashobj.update(buf)
-    return hashobj.hexdigest() == digest
+        size = os.fstat(f_in.fileno()).st_size
+        f_map = None
+        if size > 0:
+            try:
+                f_map = mmap.mmap(f_in.fileno(), size, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                # some file systems (e.g. FUSE mounts, 9p, vboxsf) can't be mapped
+                pass
+        if f_map is not None:
+            # hash the whole file in one call over a read-only mapping
+            # instead of reading it chunk by chunk
+            with f_map:
+                if hasattr(f_map, "madvise"):  # Python 3.8+
+                    f_map.madvise(mmap.MADV_SEQUENTIAL)
+                hashobj.update(f_map)
+        else:
+            while True:
+                buf = f_in.read(hashobj.block_size * 4096)
+                if not buf:
+                    break
+                hashobj.update(buf)
+    if hashobj.hexdigest() != digest:
+        if cache is not None:
+            # drop the outdated entry
+            cache.pop(path, None)
+        return False
+    if cache is not None:
+        cache[path] = file_info
+    return True
 
 
 def check_libsdl2():
@@ -138,6 +182,70 @@ def check_libsdl2():
         return False
 
 
+def check_process_by_name(name):
+    """
+    Check whether a process with the given name is running as the current user.
+
+    This scans /proc instead of running "pgrep -u <user> -x <name>"
+    and falls back to pgrep only when /proc can't be read.
+    If the process is running, this function returns True.
+    Otherwise this returns False.
+
+    name: Process name (up to 15 characters)
+    """
+    try:
+        pids = [pid for pid in os.listdir("/proc") if pid.isdigit()]
+    except OSError:
+        try:
+            subproc.check_call(
+                ("pgrep", "-u", getuser(), "-x", name), stdout=subproc.DEVNULL)
+            return True
+        except (OSError, subproc.CalledProcessError):
+            return False
+
+    comm = name.encode("utf-8") + b"\n"
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/comm", "rb") as f_comm:
+                if f_comm.read() != comm:
+                    continue
+            with open(f"/proc/{pid}/status", encoding="utf-8") as f_status:
+                status = f_status.read()
+        except (OSError, ValueError):
+            # the process has exited or isn't readable
+            continue
+        # "Uid:" line has real, effective, saved set, and filesystem UIDs
+        # (compare effective UIDs like "pgrep -u")
+        uids = re.search(r"^Uid:\s+\d+\s+(\d+)", status, re.MULTILINE)
+        if uids is not None and int(uids.group(1)) == os.geteuid():
+            return True
+    return False
+
+
+def check_process_cmdline(keyword):
+    """
+    Check whether any process has the given keyword in its command line.
+
+    This returns True if such a process is found and False if not.
+    If /proc can't be read, this returns None.
+
+    keyword: A lowercase bytes keyword (e.g. b"steam.exe")
+    """
+    try:
+        pids = [pid for pid in os.listdir("/proc") if pid.isdigit()]
+    except OSError:
+        return None
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f_cmdline:
+                if keyword in f_cmdline.read().lower():
+                    return True
+        except OSError:
+            # the process has exited or isn't readable
+            continue
+    return False
+
+
 def check_steam_process(use_proton, wine=None, env=None):
     """
     Check whether Steam client is already running.
@@ -152,107 +260,220 @@ def check_steam_process(use_proton, wine=None, env=None):
          (can be None if use_proton is True)
     """
     if use_proton:
-        try:
-            subproc.check_call(
-                ("pgrep", "-u", getuser(), "-x", "steam"), stdout=subproc.DEVNULL)
-            return True
-        except (OSError, subproc.CalledProcessError):
-            return False
-    else:
-        steam_is_running = False
-        argv = (wine, "winedbg", "--command", "info process")
-        env_wine = env.copy()
-        env_wine["WINEDLLOVERRIDES"] = "winex11.drv="
-        if "WINEPREFIX" in env_wine:
-            os.makedirs(env_wine["WINEPREFIX"], exist_ok=True)
-        try:
-            output = subproc.check_output(argv, env=env_wine, stderr=subproc.DEVNULL)
-            for line in output.decode("utf-8").splitlines():
-                line = line[:-1]  # strip last "'" for rindex()
-                try:
-                    exename = line[line.rindex("'") + 1:]
-                except ValueError:
-                    continue
-                if exename.lower().endswith("steam.exe"):
-                    steam_is_running = True
-                    break
-        except (OSError, subproc.CalledProcessError) as ex:
-            sys.exit("Failed to get Wine process list: " + ex.output.decode("utf-8"))
-        return steam_is_running
+        return check_process_by_name("steam")
 
+    # starting winedbg takes a while, skip it when no Wine process can be
+    # running in the prefix or no steam.exe process is running at all
+    if (not is_wineserver_running(
+            env.get("WINEPREFIX", os.path.join(os.path.expanduser("~"), ".wine")))
+            or check_process_cmdline(b"steam.exe") is False):
+        return False
+    argv = (wine, "winedbg", "--command", "info process")
+    env_wine = {**env, "WINEDLLOVERRIDES": "winex11.drv="}
+    if "WINEPREFIX" in env_wine:
+        os.makedirs(env_wine["WINEPREFIX"], exist_ok=True)
+    try:
+        output = subproc.check_output(argv, env=env_wine, stderr=subproc.DEVNULL)
+        # search the whole output as bytes at once
+        # e.g. " 0000003c 4        'C:\Program Files (x86)\Steam\steam.exe'"
+        steam_is_running = re.search(
+            rb"'[^'\n]*steam\.exe'", output, re.IGNORECASE) is not None
+    except (OSError, subproc.CalledProcessError) as ex:
+        sys.exit("Failed to get Wine process list: " + ex.output.decode("utf-8"))
+    return steam_is_running
+
+
+def close_connections(conns_list):
+    """
+    Close HTTP connections.
+
+    conns_list: A list of dicts of http.client.HTTPSConnection objects
+    """
+    for conns in conns_list:
+        # the dict can be modified by a worker thread at the same time
+        for conn in list(conns.values()):
+            conn.close()
+
+
+def download_file(
+        conns, host, dlfile, progress_str, *, hash_cache=None, cancel_event=None):
+    """
+    Download a file.
+
+    This returns True if the file is downloaded successfully.
+    Otherwise this returns False.
+
+    conns: A dict of reusable http.client.HTTPSConnection objects
+           whose keys are host names
+    host: Host name
+    dlfile: A tuple of (path, destination path, MD5 hex digest)
+    progress_str: The "[X/Y]" string, or None not to print download progress
+    hash_cache: A dict from load_hash_cache() or None
+                (the downloaded file is recorded so it's not hashed again)
+    cancel_event: A threading.Event object that stops downloading when set, or None
+    """
+    # pylint: disable=too-many-arguments
+
+    md5hash = new_md5()
+    dest = {}
+    path, dest["abspath"], md5 = dlfile
+    dest["name"] = os.path.basename(dest["abspath"])
+    dest["dir"] = os.path.dirname(dest["abspath"])
+    name_getting = None
+    if progress_str is not None:
+        name_getting = f"{progress_str} Get: {dest['name']}"
+        if len(name_getting) >= 49:
+            name_getting = name_getting[:45] + "..."
+    if len(dest["name"]) >= 67:
+        dest["name"] = dest["name"][:63] + "..."
+    logging.debug("Downloading file https://%s%s to %s", host, path, dest["dir"])
 
-def download_files(host, files_to_download, progress_count=None):
-    """Download files."""
-    file_count = progress_count[0] if progress_count else 1
-    num_of_files = progress_count[1] if progress_count else len(files_to_download)
-    conn = http.client.HTTPSConnection(host)
     try:
-        while len(files_to_download) > 0:
-            md5hash = hashlib.md5()
-            dest = {}
-            path, dest["abspath"], md5 = files_to_download[0]
-            dest["name"] = os.path.basename(dest["abspath"])
-            dest["dir"] = os.path.dirname(dest["abspath"])
-            name_getting = f"[{file_count}/{num_of_files}] Get: {dest['name']}"
-            if len(dest["name"]) >= 67:
-                dest["name"] = dest["name"][:63] + "..."
-            if len(name_getting) >= 49:
-                name_getting = name_getting[:45] + "..."
-            logging.debug(
-                "Downloading file https://%s%s to %s", host, path, dest["dir"])
-
-            # make file hierarchy
-            os.makedirs(dest["dir"], exist_ok=True)
-
-            # download file
-            conn.request("GET", path, headers={"Connection": "keep-alive"})
-            res = conn.getresponse()
-
-            if res.status in (301, 302, 303, 307, 308):
-                # HTTP redirection
-                newloc = urllib.parse.urlparse(res.getheader("Location"))
-                newpath = newloc.path
-                if len(newloc.query) > 0:
-                    newpath += "?" + newloc.query
-                if not download_files(
-                        newloc.netloc,
-                        [(newpath, dest["abspath"], md5), ],
-                        (file_count, num_of_files)):
-                    return False
-                # downloaded successfully from redirected URL
-                del files_to_download[0]
-                file_count += 1
-                conn = http.client.HTTPSConnection(host)
-                continue
-            if res.status != 200:
-                logging.error(
-                    "Server %s responded with status code %s.", host, res.status)
-                return False
+        # make file hierarchy
+        os.makedirs(dest["dir"], exist_ok=True)
+
+        # download file
+        res, host = get_http_response(conns, host, path)
+        if res.status != 200:
+            logging.error(
+                "Server %s responded with status code %s.", host, res.status)
+            return False
 
-            write_downloaded_file(dest["abspath"], res, md5hash, name_getting)
+        # write to a temporary file and replace the destination
+        # only when the downloaded file is complete and correct
+        partfile = dest["abspath"] + ".part"
+        try:
+            write_downloaded_file(partfile, res, md5hash, name_getting, cancel_event)
 
+            # print result lines with a newline in one write()
+            # because other threads may print progress at the same time
             if md5hash.hexdigest() != md5:
-                print(f"\r{dest['name']:67}{'MD5 MISMATCH':>12}")
+                print(f"\r{dest['name']:67}{'MD5 MISMATCH':>12}\n", end="")
                 logging.error("MD5 mismatch for %s", dest)
                 return False
+            os.replace(partfile, dest["abspath"])
+            if hash_cache is not None:
+                stat = os.stat(dest["abspath"])
+                hash_cache[dest["abspath"]] = [stat.st_size, stat.st_mtime_ns, md5]
+        finally:
+            # remove incomplete or corrupted file
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(partfile)
+    except (OSError, http.client.HTTPException) as ex:
+        # errors caused by cancelling are not reported
+        if cancel_event is None or not cancel_event.is_set():
+            logging.error("Failed to download https://%s%s: %s", host, path, ex)
+        return False
 
-            # downloaded successfully
-            print(f"\r{dest['name']:67}{'[    OK    ]':>12}")
+    # downloaded successfully
+    print(f"\r{dest['name']:67}{'[    OK    ]':>12}\n", end="")
+    return True
 
-            # skip already downloaded files
-            # when trying to download from URL.dlurlalt
-            del files_to_download[0]
 
-            file_count += 1
-    except (OSError, http.client.HTTPException) as ex:
-        logging.error("Failed to download https://%s%s: %s", host, path, ex)
-        return False
+def download_files(
+        host, files_to_download, progress_count=None, conns=None, *,
+        hash_cache=None, show_progress=True, cancel_event=None):
+    """
+    Download files.
+
+    Successfully downloaded files are removed from files_to_download
+    so that the rest can be retried with another host.
+
+    host: Host name
+    files_to_download: A list of (path, destination path, MD5 hex digest) tuples
+    progress_count: A tuple of (current file number, number of files)
+    conns: A dict of reusable http.client.HTTPSConnection objects
+           whose keys are host names (closed by the caller when given)
+    hash_cache: A dict from load_hash_cache() or None
+                (downloaded files are recorded so they're not hashed again)
+    show_progress: Whether to print download progress
+                   (result lines are always printed)
+    cancel_event: A threading.Event object that stops downloading when set, or None
+    """
+    # pylint: disable=too-many-arguments
+
+    # download multiple files in parallel unless the speed is limited
+    if (conns is None and len(files_to_download) > 1
+            and Args.download_throttle <= 0):
+        return download_files_in_parallel(
+            host, files_to_download, hash_cache=hash_cache)
+
+    file_count = progress_count[0] if progress_count else 1
+    num_of_files = progress_count[1] if progress_count else len(files_to_download)
+    is_toplevel = conns is None
+    if is_toplevel:
+        conns = {}
+    try:
+        for i, dlfile in enumerate(files_to_download):
+            progress_str = \
+                f"[{file_count + i}/{num_of_files}]" if show_progress else None
+            if ((cancel_event is not None and cancel_event.is_set())
+                    or not download_file(
+                        conns, host, dlfile, progress_str,
+                        hash_cache=hash_cache, cancel_event=cancel_event)):
+                # skip already downloaded files
+                # when trying to download from URL.dlurlalt
+                del files_to_download[:i]
+                return False
+        files_to_download.clear()
     finally:
-        conn.close()
+        if is_toplevel:
+            close_connections([conns, ])
 
     return True
 
 
+def download_files_in_parallel(
+        host, files_to_download, max_workers=4, hash_cache=None):
+    """
+    Download files in parallel.
+
+    The files are split into contiguous chunks and each chunk is downloaded
+    by download_files() in a worker thread with its own HTTPS connections.
+    Only the first worker prints download progress so that workers don't
+    overwrite the progress line of each other.
+    When interrupted (e.g. Ctrl-C), the workers are told to stop
+    and their connections are closed before waiting for them.
+    Like download_files(), downloaded files are removed from
+    files_to_download so the rest can be retried with another host.
+
+    host: Host name
+    files_to_download: A list of (path, destination path, MD5 hex digest) tuples
+    max_workers: The maximum number of worker threads
+    hash_cache: A dict from load_hash_cache() or None
+                (downloaded files are recorded so they're not hashed again)
+    """
+    num_of_files = len(files_to_download)
+    chunk_size = -(-num_of_files // max_workers)  # ceil
+    starts = range(0, num_of_files, chunk_size)
+    chunks = [files_to_download[start:start + chunk_size] for start in starts]
+    worker_conns = [{} for _ in chunks]
+    cancel_event = threading.Event()
+    try:
+        with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+            futures = [
+                executor.submit(
+                    download_files, host, chunk, (start + 1, num_of_files), conns,
+                    hash_cache=hash_cache, show_progress=i == 0,
+                    cancel_event=cancel_event)
+                for i, (chunk, start, conns)
+                in enumerate(zip(chunks, starts, worker_conns))]
+            try:
+                results = [future.result() for future in futures]
+            except BaseException:
+                # stop the workers early instead of waiting for
+                # all their files when exiting the executor
+                cancel_event.set()
+                close_connections(worker_conns)
+                raise
+    finally:
+        close_connections(worker_conns)
+
+    # remaining files in chunks are not downloaded
+    files_to_download[:] = [item for chunk in chunks for item in chunk]
+    return all(results)
+
+
 def find_discord_ipc_sockets():
     """
     Find Discord IPC sockets when using wine-discord-ipc-bridge.
@@ -294,6 +515,12 @@ def get_current_steam_user():
 
     This function depends on the package "vdf".
     """
+    # pylint: disable=import-outside-toplevel
+    try:
+        import vdf
+    except ImportError:
+        return None
+
     loginvdf_paths = File.loginusers_paths.copy()
     # try Wine Steam directory first when Wine is used
     if Args.wine:
@@ -314,6 +541,40 @@ def get_current_steam_user():
     return None
 
 
+def get_http_response(conns, host, path, max_redirects=5):
+    """
+    Send a GET request and return the response, following HTTP redirections.
+
+    This returns a tuple of (response, host name of the final response).
+    http.client.HTTPException is raised when there are too many redirections.
+
+    conns: A dict of reusable http.client.HTTPSConnection objects
+           whose keys are host names
+    host: Host name
+    path: Path with optional query string
+    max_redirects: The maximum number of redirections to follow
+    """
+    url = f"https://{host}{path}"
+    for _ in range(max_redirects + 1):
+        if host not in conns:
+            conns[host] = http.client.HTTPSConnection(host, context=get_ssl_context())
+        conns[host].request("GET", path, headers={"Connection": "keep-alive"})
+        res = conns[host].getresponse()
+        if res.status not in (301, 302, 303, 307, 308):
+            return res, host
+        # read the body so that the connection can be reused
+        res.read()
+        # "Location" can be relative to the current URL
+        url = urllib.parse.urljoin(url, res.getheader("Location"))
+        newloc = urllib.parse.urlparse(url)
+        host = newloc.netloc
+        path = newloc.path
+        if len(newloc.query) > 0:
+            path += "?" + newloc.query
+        logging.debug("Redirected to %s", url)
+    raise http.client.HTTPException(f"Too many redirections (> {max_redirects})")
+
+
 def get_mtime(files):
     """
     Get and return st_mtime from given files.
@@ -394,6 +655,17 @@ def get_short_size(size_bytes):
     return f"{size_bytes / 1048576:.1f}M"
 
 
+@functools.lru_cache(maxsize=None)
+def get_ssl_context():
+    """
+    Get the SSL context shared by HTTPS connections.
+
+    Creating a context loads the system CA certificates,
+    so it's created only once instead of for every connection.
+    """
+    return ssl.create_default_context()
+
+
 def get_steam_library_dirs(steamdir):
     """
     Get Steam library directories.
@@ -444,31 +716,39 @@ def get_steam_library_dirs(steamdir):
             f_vdf = open(
                 os.path.join(steamdir, File.steamlibvdf_inner_legacy), encoding="utf-8")
         with f_vdf:
-            for line in f_vdf:
-                # skip lines that don't have 4 quotes
-                if line.count('"') != 4:
-                    continue
-                # if the 1st quoted stuff is a (natural) number,
-                # the 2nd quoted string is a path to Steam library
-                try:
-                    elements = line.split('"')
-                    int(elements[1])
-                except (IndexError, ValueError):
-                    # in the new format (introduced in summer 2021),
-                    # Steam library directory is the value of "path"
-                    if elements[1] != "path":
-                        continue
-                # exclude AppId items in the new format
-                if os.path.sep not in elements[3]:
-                    continue
-                # as of May 2021, Steam can't add a Steam library directory
-                # that contains '"' and we can safely use the split element
-                steam_libraries.append(elements[3])
+            data = f_vdf.read()
+        # scan the whole file at once instead of splitting every line:
+        # if the 1st quoted stuff is a (natural) number,
+        # the 2nd quoted string is a path to Steam library
+        # in the new format (introduced in summer 2021),
+        # Steam library directory is the value of "path"
+        # (as of May 2021, Steam can't add a Steam library directory
+        #  that contains '"')
+        for match in re.finditer(
+                r'^[ \t]*"(?:\d+|path)"[ \t]+"([^"\n]*)"[ \t]*$', data, re.MULTILINE):
+            # exclude AppId items in the new format
+            if os.path.sep in match.group(1):
+                steam_libraries.append(match.group(1))
     except OSError:
         pass
     return steam_libraries
 
 
+def get_wine_reg_env(prefix):
+    """
+    Get a dict of environment variables for running "wine reg".
+
+    prefix: Path to Wine prefix to configure
+    """
+    env = {**os.environ, "WINEDEBUG": "-all", "WINEPREFIX": prefix}
+    if Args.proton:
+        env.update(
+            WINEESYNC="0" if is_envar_enabled(env, "PROTON_NO_ESYNC") else "1",
+            WINEFSYNC="0" if is_envar_enabled(env, "PROTON_NO_FSYNC") else "1",
+        )
+    return env
+
+
 def is_d3dcompiler_setup_skippable():
     """
     Check whether native d3dcompiler setup can be skipped.
@@ -491,11 +771,16 @@ def is_d3dcompiler_setup_skippable():
     if Args.proton:
         wine_prefix = os.path.join(wine_prefix, "pfx")
     installed_dll_path = os.path.join(wine_prefix, File.d3dcompiler_47_inner)
+    # this is checked on every start, don't hash the unchanged DLL every time
+    hash_cache = load_hash_cache()
+    original_hash_cache = hash_cache.copy()
     try:
-        if check_hash(installed_dll_path, File.d3dcompiler_47_md5, hashlib.md5()):
+        if check_hash(
+                installed_dll_path, File.d3dcompiler_47_md5, new_md5(), hash_cache):
             have_native_dll = True
     except OSError:
         pass
+    save_hash_cache(hash_cache, original_hash_cache)
     if not have_native_dll:
         logging.debug("Native d3dcompiler_47.dll is not found")
         return False
@@ -551,13 +836,8 @@ def is_dos_style_abspath(path):
 
     path: A path string
     """
-    if len(path) < 3:
-        return False
-    drv = path[0]  # drive letter
-    # A:65, B:66, ... Z:90, a:97, b:98, ... z:122
-    if ord(drv) < 65 or (ord(drv) > 90 and ord(drv) < 97) or ord(drv) > 122:
-        return False
-    return path[1:3] == ":\\"
+    # drive letter (A-Z or a-z), ":", and "\\"
+    return re.match(r"[A-Za-z]:\\", path) is not None
 
 
 def is_envar_enabled(envars, name):
@@ -571,10 +851,29 @@ def is_envar_enabled(envars, name):
     envars: A dict of environment variables
     name: The name of environment variable to check
     """
-    if name not in envars:
+    value = envars.get(name)
+    return bool(value) and value != "0"
+
+
+def is_wineserver_running(prefix):
+    """
+    Check whether wineserver may be running for the given Wine prefix.
+
+    This returns False only when the prefix or the wineserver socket
+    doesn't exist. Otherwise this returns True.
+
+    prefix: A path to Wine prefix
+    """
+    try:
+        stat = os.stat(prefix)
+    except FileNotFoundError:
         return False
-    value = envars[name]
-    return len(value) > 0 and value != "0"
+    except OSError:
+        return True
+    # wineserver creates its socket in
+    # "/tmp/.wine-<UID>/server-<device number>-<inode number of the prefix>"
+    return os.path.exists(
+        f"/tmp/.wine-{os.getuid()}/server-{stat.st_dev:x}-{stat.st_ino:x}/socket")
 
 
 def is_within_directory(dir1, dir2):
@@ -588,6 +887,23 @@ def is_within_directory(dir1, dir2):
     return os.path.commonpath((dir2_abs, os.path.abspath(dir1))) == dir2_abs
 
 
+def load_hash_cache():
+    """
+    Load and return the cache for check_hash().
+
+    The cache is a dict of {path: [size, mtime_ns, hex digest]}.
+    If the cache file can't be loaded, this returns an empty dict.
+    """
+    try:
+        with open(File.hash_cache, encoding="utf-8") as f_in:
+            cache = json.load(f_in)
+        if isinstance(cache, dict):
+            return cache
+    except (OSError, ValueError):
+        pass
+    return {}
+
+
 def log_info_formatted_envars_and_args(runner, env_print, env, args):
     """
     Print formatted envars and command line with logging level "info".
@@ -597,12 +913,10 @@ def log_info_formatted_envars_and_args(runner, env_print, env, args):
     env: A dict of environment variables
     args: Command line
     """
-    env_str = ""
-    cmd_str = ""
-    name_value_pairs = []
-    for name in env_print:
-        name_value_pairs.append(f"{name}={env[name]}")
-    env_str += "\n  ".join(name_value_pairs) + "\n  "
+    # don't build the strings when they won't be printed
+    if not logging.getLogger().isEnabledFor(logging.INFO):
+        return
+    env_str = "\n  ".join(f"{name}={env[name]}" for name in env_print) + "\n  "
     args_print = []
     opts_print = []
     # print game options in one line
@@ -614,8 +928,21 @@ def log_info_formatted_envars_and_args(runner, env_print, env, args):
         args_print.append(arg)
     if len(opts_print) > 0:
         args_print.append("  " + " ".join(opts_print))
-    cmd_str += "\n    ".join(args_print)
-    logging.info("Running %s:\n  %s%s", runner, env_str, cmd_str)
+    logging.info(
+        "Running %s:\n  %s%s", runner, env_str, "\n    ".join(args_print))
+
+
+def new_md5():
+    """
+    Create an MD5 object for file integrity checks.
+
+    MD5 is not used for security here, so it's marked as such (Python 3.9+)
+    to keep it available on FIPS-enabled systems.
+    """
+    try:
+        return hashlib.md5(usedforsecurity=False)
+    except TypeError:
+        return hashlib.md5()
 
 
 def perform_self_update():
@@ -649,20 +976,24 @@ def perform_self_update():
     # retrieve the release asset
     archive_url = URL.rel_tarxz_tmpl.format(release)
     logging.info("Retrieving release asset %s", archive_url)
-    try:
-        with urllib.request.urlopen(archive_url) as f_in:
-            asset_archive = f_in.read()
-    except OSError as ex:
-        sys.exit(f"Failed to retrieve release asset file: {ex}")
-
-    # unpack the archive
-    logging.info("Unpacking archive %s", archive_url)
-    topdir = os.path.dirname(Dir.scriptdir)
-    try:
-        with tarfile.open(fileobj=io.BytesIO(asset_archive), mode="r:xz") as f_in:
-            check_and_unpack_tar(f_in, path=topdir)
-    except (OSError, tarfile.TarError) as ex:
-        sys.exit(f"Failed to unpack release asset file: {ex}")
+    # (the archive is streamed into a temporary file instead of memory;
+    #  it can't be unpacked in stream mode because members are checked first)
+    with tempfile.TemporaryFile() as asset_archive:
+        try:
+            with urllib.request.urlopen(archive_url) as f_in:
+                shutil.copyfileobj(f_in, asset_archive, 1 << 20)
+        except OSError as ex:
+            sys.exit(f"Failed to retrieve release asset file: {ex}")
+        asset_archive.seek(0)
+
+        # unpack the archive
+        logging.info("Unpacking archive %s", archive_url)
+        topdir = os.path.dirname(Dir.scriptdir)
+        try:
+            with tarfile.open(fileobj=asset_archive, mode="r:xz") as f_in:
+                check_and_unpack_tar(f_in, path=topdir)
+        except (OSError, tarfile.TarError) as ex:
+            sys.exit(f"Failed to unpack release asset file: {ex}")
 
     # update files
     archive_dir = os.path.join(topdir, "truckersmp-cli-" + release)
@@ -696,6 +1027,60 @@ def print_child_output(proc):
                 "!! NON UNICODE OUTPUT !!", repr(line), sep="  ", end="", flush=True)
 
 
+def print_download_progress(
+        name_getting, downloaded, content_len=0, short_content_len=None):
+    """
+    Print download progress.
+
+    name_getting: The "[X/Y] Get:" string
+    downloaded: Downloaded size in bytes
+    content_len: The value of "Content-Length" header as int, or 0 if unknown
+    short_content_len: get_short_size(content_len) formatted by the caller
+                       (it doesn't change during a download)
+    """
+    if content_len:
+        if short_content_len is None:
+            short_content_len = get_short_size(content_len)
+        ten_percent_count = int(downloaded * 10 / content_len)
+        # downloaded / length [progressbar]
+        # e.g. 555.5K / 777.7K [=======>  ]
+        progress = f"{get_short_size(downloaded)} / " \
+                   f"{short_content_len} " \
+                   f"[{'=' * ten_percent_count}" \
+                   f"{'>' if ten_percent_count < 10 else ''}" \
+                   f"{' ' * max(9 - ten_percent_count, 0)}]"
+    else:
+        progress = get_short_size(downloaded)
+    print(f"\r{name_getting:49}{progress:>30}", end="")
+
+
+def save_hash_cache(cache, original_cache=None):
+    """
+    Save the cache for check_hash().
+
+    Entries of files that no longer exist are dropped.
+
+    cache: A dict from load_hash_cache()
+    original_cache: A copy of the cache made right after loading it, or None
+                    (the cache file isn't rewritten if nothing is changed)
+    """
+    if original_cache is not None and cache == original_cache:
+        return
+    cache = {path: info for path, info in cache.items() if os.path.isfile(path)}
+    # write to a temporary file and replace the cache file
+    # so that a concurrent load_hash_cache() never sees a partial file
+    tmp_path = f"{File.hash_cache}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(File.hash_cache), exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f_out:
+            json.dump(cache, f_out)
+        os.replace(tmp_path, File.hash_cache)
+    except OSError as ex:
+        logging.debug("Failed to save hash cache: %s", ex)
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+
+
 def setup_wine_discord_ipc_bridge():
     """
     Check and download wine-discord-ipc-bridge.
@@ -705,9 +1090,12 @@ def setup_wine_discord_ipc_bridge():
     When ready, this function returns the path to wine-discord-ipc-bridge.
     """
     # check whether the file is already downloaded
+    # (the unchanged file is not hashed again)
     need_download = True
+    hash_cache = load_hash_cache()
+    original_hash_cache = hash_cache.copy()
     try:
-        if check_hash(File.ipcbridge, File.ipcbridge_md5, hashlib.md5()):
+        if check_hash(File.ipcbridge, File.ipcbridge_md5, new_md5(), hash_cache):
             logging.debug("winediscordipcbridge.exe is present, MD5 is OK.")
             need_download = False
     except OSError:
@@ -719,8 +1107,10 @@ def setup_wine_discord_ipc_bridge():
         logging.debug("Downloading winediscordipcbridge.exe")
         os.makedirs(Dir.ipcbrdir, exist_ok=True)
         if not download_files(
-                URL.github, [(URL.ipcbrpath, File.ipcbridge, File.ipcbridge_md5), ]):
+                URL.github, [(URL.ipcbrpath, File.ipcbridge, File.ipcbridge_md5), ],
+                hash_cache=hash_cache):
             sys.exit("Failed to download winediscordipcbridge.exe")
+    save_hash_cache(hash_cache, original_hash_cache)
 
     return File.ipcbridge
 
@@ -737,35 +1127,31 @@ def set_wine_desktop_registry(prefix, wine, enable):
     wine: A list used to run Wine executable
     enable: Whether to enable Wine desktop
     """
-    env = os.environ.copy()
-    env.update(WINEDEBUG="-all", WINEPREFIX=prefix)
-    if Args.proton:
-        env.update(
-            WINEESYNC="0" if is_envar_enabled(env, "PROTON_NO_ESYNC") else "1",
-            WINEFSYNC="0" if is_envar_enabled(env, "PROTON_NO_FSYNC") else "1",
-        )
-    regkey_explorer = "HKCU\\Software\\Wine\\Explorer"
-    regkey_desktops = "HKCU\\Software\\Wine\\Explorer\\Desktops"
+    env = get_wine_reg_env(prefix)
+    # write all changes to a .reg file and import it with a single
+    # "wine reg" process because starting Wine takes a while
+    # ("=-" deletes the value)
     if enable:
         logging.info("Enabling Wine desktop (%s)", Args.wine_desktop)
-        subproc.call(
-            wine + [
-                "reg", "add", regkey_explorer,
-                "/v", "Desktop", "/t", "REG_SZ", "/d", "Default", "/f"],
-            env=env)
-        subproc.call(
-            wine + [
-                "reg", "add", regkey_desktops,
-                "/v", "Default", "/t", "REG_SZ", "/d", Args.wine_desktop, "/f"],
-            env=env)
+        desktop = Args.wine_desktop.replace("\\", "\\\\").replace('"', '\\"')
+        values = ('"Desktop"="Default"', f'"Default"="{desktop}"')
     else:
         logging.info("Disabling Wine desktop")
+        values = ('"Desktop"=-', '"Default"=-')
+    regkey_explorer = "HKEY_CURRENT_USER\\Software\\Wine\\Explorer"
+    # the file is created in "drive_c" so that Wine can open it as "C:\..."
+    drive_c = os.path.join(prefix, "drive_c")
+    os.makedirs(drive_c, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-16", newline="\r\n",
+            dir=drive_c, prefix="truckersmp-cli-", suffix=".reg") as f_reg:
+        f_reg.write(
+            "Windows Registry Editor Version 5.00\n\n"
+            f"[{regkey_explorer}]\n{values[0]}\n\n"
+            f"[{regkey_explorer}\\Desktops]\n{values[1]}\n")
+        f_reg.flush()
         subproc.call(
-            wine + [
-                "reg", "delete", regkey_explorer, "/v", "Desktop", "/f"], env=env)
-        subproc.call(
-            wine + [
-                "reg", "delete", regkey_desktops, "/v", "Default", "/f"], env=env)
+            wine + ["reg", "import", "C:\\" + os.path.basename(f_reg.name)], env=env)
 
 
 def wait_for_loginvdf_update(
@@ -782,14 +1168,19 @@ def wait_for_loginvdf_update(
     timeout: timeout in seconds
     """
     steamdir = None
-    waittime = timeout
-    while waittime > 0:
-        print(ngettext(
-            "\rWaiting {} second for steam to start up. ",
-            "\rWaiting {} seconds for steam to start up. ",
-            waittime).format(waittime), end="")
-        time.sleep(1)
-        waittime -= 1
+    deadline = time.monotonic() + timeout
+    shown_waittime = None
+    while time.monotonic() < deadline:
+        # update the countdown every second but check timestamps
+        # several times per second to notice the login soon
+        waittime = math.ceil(deadline - time.monotonic())
+        if waittime != shown_waittime:
+            print(ngettext(
+                "\rWaiting {} second for steam to start up. ",
+                "\rWaiting {} seconds for steam to start up. ",
+                waittime).format(waittime), end="")
+            shown_waittime = waittime
+        time.sleep(0.25)
         for i, path in enumerate(loginvdfs_checked):
             try:
                 stat = os.stat(path)
@@ -883,53 +1274,68 @@ def wait_for_steam(use_proton, loginvdf_paths, wine=None, env=None):
     return steamdir
 
 
-def write_downloaded_file(outfile, res, md5hash, name_getting):
+def write_downloaded_file(outfile, res, md5hash, name_getting, cancel_event=None):
     """
     Write downloaded file.
 
     outfile: A path to destination file
     res: A response from getresponse()
     md5hash: An md5 object
-    name_getting: The "[X/Y] Get:" string
+    name_getting: The "[X/Y] Get:" string, or None not to print progress
+    cancel_event: A threading.Event object that stops downloading when set, or None
+                  (InterruptedError is raised when stopped)
     """
-    bufsize = md5hash.block_size * 256
+    # pylint: disable=too-many-locals
+
+    # read up to 1 MiB at once to reduce per-chunk overhead
+    bufsize = 1 << 20
+    # format the total size only once, not on every progress update
+    try:
+        content_len = int(res.getheader("Content-Length"))
+    except (TypeError, ValueError):
+        content_len = 0
+    short_content_len = get_short_size(content_len)
     with open(outfile, "wb") as f_out:
         downloaded = 0
+        last_printed = 0.0
+        # the time when the next read is allowed with the speed limit
+        next_read_time = time.monotonic()
         while True:
-            if Args.download_throttle > 0:
-                time_before_download = time.time()
-            buf = res.read(bufsize)
+            if cancel_event is not None and cancel_event.is_set():
+                raise InterruptedError("Download cancelled")
+            # read1() returns available data without waiting for the full buffer
+            buf = res.read1(bufsize)
             if not buf:
+                # read1() doesn't close the response at EOF until Python 3.13,
+                # close it so that the next request can reuse the connection
+                res.close()
                 break
             if Args.download_throttle > 0:
                 # wait if the speed is too fast
-                while (time.time() - time_before_download < bufsize / (
-                        1024 * Args.download_throttle)):
-                    time.sleep(0.001)
+                # (sleep once instead of polling the clock)
+                next_read_time += len(buf) / (1024 * Args.download_throttle)
+                time.sleep(max(next_read_time - time.monotonic(), 0))
+                # don't save up unused time for a burst
+                next_read_time = max(next_read_time, time.monotonic())
             downloaded += len(buf)
             f_out.write(buf)
             md5hash.update(buf)
-            content_len = res.getheader("Content-Length")
-            if content_len:
-                int_content_len = int(content_len)
-                ten_percent_count = int(downloaded * 10 / int_content_len)
-                # downloaded / length [progressbar]
-                # e.g. 555.5K / 777.7K [=======>  ]
-                progress = f"{get_short_size(downloaded)} / " \
-                           f"{get_short_size(int_content_len)} " \
-                           f"[{'=' * ten_percent_count}" \
-                           f"{'>' if ten_percent_count < 10 else ''}" \
-                           f"{' ' * max(9 - ten_percent_count, 0)}]"
-            else:
-                progress = get_short_size(downloaded)
-            print(f"\r{name_getting:49}{progress:>30}", end="")
-
-            # wget-like timestamping for downloaded files
-            lastmod = res.getheader("Last-Modified")
-            if lastmod:
-                timestamp = time.mktime(
-                    time.strptime(lastmod, "%a, %d %b %Y %H:%M:%S GMT")) - time.timezone
-                try:
-                    os.utime(outfile, (timestamp, timestamp))
-                except OSError:
-                    pass
+            # update progress at most 10 times per second
+            now = time.monotonic()
+            if name_getting is not None and now - last_printed >= 0.1:
+                print_download_progress(
+                    name_getting, downloaded, content_len, short_content_len)
+                last_printed = now
+        if name_getting is not None:
+            print_download_progress(
+                name_getting, downloaded, content_len, short_content_len)
+
+    # wget-like timestamping for downloaded files
+    # (done after closing the file so that the last write doesn't update mtime)
+    lastmod = res.getheader("Last-Modified")
+    if lastmod:
+        try:
+            timestamp = parsedate_to_datetime(lastmod).timestamp()
+            os.utime(outfile, (timestamp, timestamp))
+        except (OSError, TypeError, ValueError):
+            pass
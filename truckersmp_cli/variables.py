@@ -77,6 +77,7 @@ class File:
     ipcbridge = os.path.join(Dir.ipcbrdir, "winediscordipcbridge.exe")
     ipcbridge_md5 = "a433fb2ec994b664b662e798095f9059"
     sdl2_soname = "libSDL2-2.0.so.0"
+    hash_cache = os.path.join(Dir.truckersmp_cli_data, "hashcache.json")
     flatpak_helper = os.path.join(Dir.scriptdir, "flatpak_helper.py")
     steamruntime_helper = os.path.join(Dir.scriptdir, "steamruntime_helper.py")
 